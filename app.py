@@ -2,9 +2,15 @@ import os
 import logging
 from flask import Flask, render_template, request, jsonify, session
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, insert, select
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 import random
+import time
+import queue
+import threading
+import atexit
+from collections import deque, namedtuple
 from datetime import datetime
 
 # Configura o log
@@ -19,6 +25,8 @@ db = SQLAlchemy(model_class=Base)
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "default_secret_key")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+# Serializa as respostas JSON sem ordenar as chaves
+app.json.sort_keys = False
 
 # Configura o banco de dados
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///mathgame.db")
@@ -26,6 +34,19 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
+app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+    # Dimensiona o pool para requisições concorrentes (o SQLite em memória não aceita essas opções)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update({
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_timeout": 5,
+    })
+if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgres"):
+    # Limita o tempo de cada consulta no Postgres para não prender conexões do pool
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]["connect_args"] = {
+        "options": "-c statement_timeout=2000"
+    }
 
 # Inicializa o aplicativo com a extensão
 db.init_app(app)
@@ -34,65 +55,325 @@ with app.app_context():
     import models
     db.create_all()
 
+# Gravação dos resultados em lote, fora do ciclo da requisição.
+# Resultados que não entram no ranking são gravados por uma thread em segundo plano,
+# então podem levar alguns instantes para aparecer no banco (consistência eventual).
+RESULT_BATCH_SIZE = 100
+RESULT_SAVE_ATTEMPTS = 3
+RESULT_WRITER_JOIN_TIMEOUT = 10
+_STOP_WRITER = object()
+_result_queue = queue.Queue()
+_result_writer = None
+_result_writer_lock = threading.Lock()
+
+def _save_results(batch):
+    """Grava um lote de resultados de jogos no banco de dados"""
+    with app.app_context(), db.session.no_autoflush:
+        try:
+            db.session.execute(insert(models.GameResult), batch)
+            leaderboard_changed = _update_leaderboard(batch)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    if leaderboard_changed:
+        _invalidate_leaderboard()
+
+def _save_results_with_retry(batch):
+    """Grava o lote, tentando novamente em caso de falha antes de desistir"""
+    for attempt in range(1, RESULT_SAVE_ATTEMPTS + 1):
+        try:
+            _save_results(batch)
+            return
+        except Exception:
+            logging.exception("Falha ao gravar resultados de jogos (tentativa %d de %d)",
+                              attempt, RESULT_SAVE_ATTEMPTS)
+            if attempt < RESULT_SAVE_ATTEMPTS:
+                time.sleep(attempt)
+    # Registra os resultados perdidos para que possam ser recuperados manualmente
+    for data in batch:
+        logging.error("Resultado de jogo não gravado: %r", data)
+
+def _write_results_forever():
+    """Laço da thread de gravação dos resultados; termina ao receber _STOP_WRITER"""
+    stopping = False
+    while not stopping:
+        batch = []
+        item = _result_queue.get()
+        while True:
+            if item is _STOP_WRITER:
+                stopping = True
+            else:
+                batch.append(item)
+            if stopping or len(batch) >= RESULT_BATCH_SIZE:
+                break
+            try:
+                item = _result_queue.get_nowait()
+            except queue.Empty:
+                break
+        if batch:
+            _save_results_with_retry(batch)
+
+def enqueue_result(data):
+    """Agenda a gravação de um resultado, iniciando a thread de gravação se necessário"""
+    global _result_writer
+    if _result_writer is None:
+        with _result_writer_lock:
+            if _result_writer is None:
+                _result_writer = threading.Thread(target=_write_results_forever, daemon=True)
+                _result_writer.start()
+    _result_queue.put(data)
+
+def _reset_writer_after_fork():
+    """Descarta no processo filho a fila e a thread de gravação herdadas do pai"""
+    global _result_queue, _result_writer, _result_writer_lock
+    _result_queue = queue.Queue()
+    _result_writer = None
+    _result_writer_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_writer_after_fork)
+
+@atexit.register
+def _flush_results():
+    """Grava os resultados pendentes ao encerrar o processo"""
+    if _result_writer is not None:
+        # A thread grava o que já retirou da fila e o que ainda está nela antes de parar
+        _result_queue.put(_STOP_WRITER)
+        _result_writer.join(RESULT_WRITER_JOIN_TIMEOUT)
+        if _result_writer.is_alive():
+            logging.error("Thread de gravação não terminou; %d resultados pendentes",
+                          _result_queue.qsize())
+
+# Ranking materializado: a tabela LeaderboardEntry guarda só as 10 melhores pontuações
+LEADERBOARD_SIZE = 10
+
+def _leaderboard_threshold():
+    """Pontuação a ser superada para entrar no ranking, ou None se ainda houver vaga"""
+    Leaderboard = models.LeaderboardEntry
+    count, min_top = db.session.query(func.count(Leaderboard.id), func.min(Leaderboard.score)).one()
+    return min_top if count >= LEADERBOARD_SIZE else None
+
+def _update_leaderboard(batch):
+    """Insere no ranking os resultados do lote que superam o último colocado
+
+    Retorna True se o ranking mudou.
+    """
+    Leaderboard = models.LeaderboardEntry
+    min_top = _leaderboard_threshold()
+    if min_top is not None:
+        batch = [data for data in batch if data['score'] > min_top]
+    if not batch:
+        return False
+
+    db.session.add_all([
+        Leaderboard(
+            difficulty=data['difficulty'],
+            score=data['score'],
+            accuracy=data['accuracy'],
+            created_at=data['created_at']
+        )
+        for data in batch
+    ])
+    db.session.flush()
+
+    # Remove quem saiu das 10 primeiras posições
+    stale_ids = [row.id for row in db.session.query(Leaderboard.id)
+                 .order_by(Leaderboard.score.desc(), Leaderboard.id)
+                 .offset(LEADERBOARD_SIZE)]
+    if stale_ids:
+        db.session.query(Leaderboard).filter(Leaderboard.id.in_(stale_ids)).delete(synchronize_session=False)
+    return True
+
+@app.cli.command('rebuild-leaderboard')
+def rebuild_leaderboard():
+    """Reconstrói o ranking a partir da tabela GameResult
+
+    Comando único de implantação (flask --app app rebuild-leaderboard): não roda
+    na importação, para que vários workers iniciando juntos não dupliquem o ranking.
+    Pode ser repetido com segurança, pois recria a tabela do zero.
+    """
+    Leaderboard = models.LeaderboardEntry
+    GameResult = models.GameResult
+    top_scores = db.session.query(
+        GameResult.difficulty,
+        GameResult.score,
+        GameResult.accuracy,
+        GameResult.created_at
+    ).order_by(GameResult.score.desc()).limit(LEADERBOARD_SIZE).all()
+    db.session.query(Leaderboard).delete(synchronize_session=False)
+    db.session.add_all([Leaderboard(**row._asdict()) for row in top_scores])
+    db.session.commit()
+    print(f"Ranking reconstruído com {len(top_scores)} resultados")
+
+# Cache do ranking (as 10 melhores pontuações mudam raramente)
+LEADERBOARD_CACHE_TTL = 15
+# A geração é incrementada a cada invalidação; uma leitura iniciada antes dela
+# não pode mais preencher o cache
+_leaderboard_cache = {'leaderboard': None, 'expires': 0.0, 'generation': 0}
+_leaderboard_cache_lock = threading.Lock()
+
+def _invalidate_leaderboard():
+    """Descarta o ranking em cache"""
+    with _leaderboard_cache_lock:
+        _leaderboard_cache['generation'] += 1
+        _leaderboard_cache['expires'] = 0.0
+
 # Configuração do jogo
 DIFFICULTY_SETTINGS = {
     'easy': {
         'max_number': 10,
-        'operations': ['+', '-'],
+        'operations': ('+', '-'),
         'time_limit': 30
     },
     'medium': {
         'max_number': 50,
-        'operations': ['+', '-', '*'],
+        'operations': ('+', '-', '*'),
         'time_limit': 20
     },
     'hard': {
         'max_number': 100,
-        'operations': ['+', '-', '*', '/'],
+        'operations': ('+', '-', '*', '/'),
         'time_limit': 15
     }
 }
 
-def generate_question(difficulty):
-    """Gera uma pergunta de matemática com base no nível de dificuldade"""
-    settings = DIFFICULTY_SETTINGS[difficulty]
-    operation = random.choice(settings['operations'])
-    
-    # Inicializa variáveis
-    question = ""
-    answer = 0
-
-    if operation == '+':
-        num1 = random.randint(1, settings['max_number'])
-        num2 = random.randint(1, settings['max_number'])
-        answer = num1 + num2
-        question = f"{num1} + {num2}"
-
-    elif operation == '-':
-        num1 = random.randint(1, settings['max_number'])
-        num2 = random.randint(1, num1)  # Garante um resultado positivo
-        answer = num1 - num2
-        question = f"{num1} - {num2}"
-
-    elif operation == '*':
-        num1 = random.randint(1, min(settings['max_number'] // 5, 12))
-        num2 = random.randint(1, min(settings['max_number'] // 5, 12))
-        answer = num1 * num2
-        question = f"{num1} × {num2}"
-
-    elif operation == '/':
-        # Gera uma divisão que resulta em números inteiros
-        answer = random.randint(1, min(settings['max_number'] // 5, 12))
-        num2 = random.randint(2, min(settings['max_number'] // 10, 10))
-        num1 = answer * num2
-        question = f"{num1} ÷ {num2}"
+# Gerador aleatório próprio, com os métodos já vinculados
+_rng = random.Random()
+_randrange = _rng.randrange
+_choice = _rng.choice
+
+def _gen_add(settings):
+    """Gera uma adição, retornando (pergunta, resposta)"""
+    num1 = _randrange(1, settings.number_stop)
+    num2 = _randrange(1, settings.number_stop)
+    return f"{num1} + {num2}", num1 + num2
+
+def _gen_sub(settings):
+    """Gera uma subtração, retornando (pergunta, resposta)"""
+    num1 = _randrange(1, settings.number_stop)
+    num2 = _randrange(1, num1 + 1)  # Garante um resultado positivo
+    return f"{num1} - {num2}", num1 - num2
+
+def _gen_mul(settings):
+    """Gera uma multiplicação, retornando (pergunta, resposta)"""
+    num1 = _randrange(1, settings.mul_stop)
+    num2 = _randrange(1, settings.mul_stop)
+    return f"{num1} × {num2}", num1 * num2
+
+def _gen_div(settings):
+    """Gera uma divisão, retornando (pergunta, resposta)"""
+    # Gera uma divisão que resulta em números inteiros
+    answer = _randrange(1, settings.div_answer_stop)
+    num2 = _randrange(2, settings.div_divisor_stop)
+    return f"{answer * num2} ÷ {num2}", answer
+
+_OP_GENERATORS = {
+    '+': _gen_add,
+    '-': _gen_sub,
+    '*': _gen_mul,
+    '/': _gen_div
+}
 
+# Configurações de cada dificuldade já resolvidas: limites exclusivos (para randrange)
+# dos operandos e geradores das operações
+DifficultySettings = namedtuple('DifficultySettings', [
+    'time_limit',
+    'number_stop',
+    'mul_stop',
+    'div_answer_stop',
+    'div_divisor_stop',
+    'generators'
+])
+
+def _compile_settings(config):
+    """Pré-calcula as configurações de uma dificuldade de DIFFICULTY_SETTINGS"""
+    max_number = config['max_number']
+    return DifficultySettings(
+        time_limit=config['time_limit'],
+        number_stop=max_number + 1,
+        mul_stop=min(max_number // 5, 12) + 1,
+        div_answer_stop=min(max_number // 5, 12) + 1,
+        div_divisor_stop=min(max_number // 10, 10) + 1,
+        generators=tuple(_OP_GENERATORS[op] for op in config['operations'])
+    )
+
+# A dificuldade é convertida em índice na entrada da requisição (start_game)
+DIFFICULTY_INDEX = {difficulty: idx for idx, difficulty in enumerate(DIFFICULTY_SETTINGS)}
+_SETTINGS_BY_IDX = tuple(_compile_settings(config) for config in DIFFICULTY_SETTINGS.values())
+
+def _build_question(settings):
+    """Gera uma pergunta de matemática com base nas configurações da dificuldade"""
+    question, answer = _choice(settings.generators)(settings)
     return {
         'question': question,
         'answer': answer,
-        'time_limit': settings['time_limit']
+        'time_limit': settings.time_limit
     }
 
+def _build_questions(difficulty_idx, count):
+    """Gera um lote de perguntas, resolvendo as configurações uma única vez"""
+    settings = _SETTINGS_BY_IDX[difficulty_idx]
+    build = _build_question
+    return [build(settings) for _ in range(count)]
+
+# Reservas de perguntas pré-geradas por dificuldade, reabastecidas em segundo plano
+QUESTION_POOL_SIZE = 1024
+QUESTION_POOL_LOW_WATER = 128
+_question_pools = tuple(deque() for _ in _SETTINGS_BY_IDX)
+_refilling = set()
+_refill_lock = threading.Lock()
+
+def _refill_pool(difficulty_idx):
+    """Completa a reserva de perguntas da dificuldade até QUESTION_POOL_SIZE"""
+    pool = _question_pools[difficulty_idx]
+    try:
+        pool.extend(_build_questions(difficulty_idx, QUESTION_POOL_SIZE - len(pool)))
+    finally:
+        with _refill_lock:
+            _refilling.discard(difficulty_idx)
+
+def _schedule_refill(difficulty_idx):
+    """Inicia o reabastecimento da reserva em uma thread, se ainda não houver um em andamento"""
+    with _refill_lock:
+        if difficulty_idx in _refilling:
+            return
+        _refilling.add(difficulty_idx)
+    threading.Thread(target=_refill_pool, args=(difficulty_idx,), daemon=True).start()
+
+def _fill_pools():
+    """Completa as reservas de todas as dificuldades"""
+    for difficulty_idx in range(len(_SETTINGS_BY_IDX)):
+        _refill_pool(difficulty_idx)
+
+_fill_pools()
+
+def _reset_questions_after_fork():
+    """Ressemeia o gerador e descarta as perguntas herdadas do processo pai
+
+    Sem isso, todos os workers criados a partir de um mestre pré-carregado
+    (gunicorn --preload) serviriam a mesma sequência de perguntas.
+    """
+    global _refill_lock
+    _rng.seed()
+    # A trava pode ter sido copiada ocupada por uma thread que não existe no filho
+    _refill_lock = threading.Lock()
+    _refilling.clear()
+    for pool in _question_pools:
+        pool.clear()
+    _fill_pools()
+
+os.register_at_fork(after_in_child=_reset_questions_after_fork)
+
+def generate_question(difficulty_idx):
+    """Retira uma pergunta da reserva da dificuldade, gerando-a na hora se a reserva estiver vazia"""
+    pool = _question_pools[difficulty_idx]
+    if len(pool) < QUESTION_POOL_LOW_WATER:
+        _schedule_refill(difficulty_idx)
+    try:
+        return pool.popleft()
+    except IndexError:
+        return _build_question(_SETTINGS_BY_IDX[difficulty_idx])
+
 @app.route('/')
 def index():
     """Página principal do jogo"""
@@ -103,19 +384,21 @@ def start_game():
     """Inicia um novo jogo com a dificuldade selecionada"""
     data = request.get_json()
     difficulty = data.get('difficulty', 'easy')
+    difficulty_idx = DIFFICULTY_INDEX[difficulty]
 
     # Inicializa a sessão do jogo
     session['game_active'] = True
     session['difficulty'] = difficulty
+    session['difficulty_idx'] = difficulty_idx
     session['score'] = 0
     session['total_questions'] = 0
     session['correct_answers'] = 0
-    session['start_time'] = datetime.now().isoformat()
+    session['start_time'] = time.time()
 
     # Gera a primeira pergunta
-    question_data = generate_question(difficulty)
-    session['current_question'] = question_data
-    session['question_start_time'] = datetime.now().isoformat()
+    question_data = generate_question(difficulty_idx)
+    session['answer'] = question_data['answer']
+    session['question_start_time'] = session['start_time']
 
     return jsonify({
         'success': True,
@@ -123,56 +406,70 @@ def start_game():
         'time_limit': question_data['time_limit']
     })
 
-@app.route('/submit_answer', methods=['POST'])
-def submit_answer():
-    """Envia uma resposta e obtém a próxima pergunta"""
-    if not session.get('game_active'):
-        return jsonify({'success': False, 'error': 'Nenhum jogo ativo'})
-
-    data = request.get_json()
-    user_answer = data.get('answer')
-
-    current_question = session.get('current_question')
-    if not current_question:
-        return jsonify({'success': False, 'error': 'Nenhuma pergunta atual'})
+def _score_answer(state, user_answer, now_ts):
+    """Confere a resposta e calcula as novas estatísticas, sem tocar na sessão
 
+    Retorna o estado atualizado (score, total_questions, correct_answers)
+    e os campos de resposta correspondentes.
+    """
     try:
         user_answer = int(user_answer)
     except (ValueError, TypeError):
         user_answer = None
 
-    correct_answer = current_question['answer']
+    correct_answer = state['answer']
     is_correct = user_answer == correct_answer
 
     # Atualiza as estatísticas
-    session['total_questions'] += 1
+    score = state['score']
+    total_questions = state['total_questions'] + 1
+    correct_answers = state['correct_answers']
     if is_correct:
-        session['correct_answers'] += 1
-        session['score'] += 10  # 10 pontos por resposta correta
-
-    # Calcula o tempo gasto
-    question_start = datetime.fromisoformat(session['question_start_time'])
-    time_taken = (datetime.now() - question_start).total_seconds()
+        correct_answers += 1
+        score += 10  # 10 pontos por resposta correta
 
     # Pontos de bônus para respostas rápidas (se respondida em menos da metade do tempo limite)
-    if is_correct and time_taken < (current_question['time_limit'] / 2):
-        bonus_points = max(1, int(10 - time_taken))
-        session['score'] += bonus_points
+    time_taken = now_ts - state['question_start_time']
+    time_limit = _SETTINGS_BY_IDX[state['difficulty_idx']].time_limit
+    if is_correct and time_taken < (time_limit / 2):
+        score += max(1, int(10 - time_taken))
+
+    new_state = {
+        'score': score,
+        'total_questions': total_questions,
+        'correct_answers': correct_answers
+    }
+    response = {
+        'is_correct': is_correct,
+        'correct_answer': correct_answer,
+        **new_state
+    }
+    return new_state, response
+
+@app.route('/submit_answer', methods=['POST'])
+def submit_answer():
+    """Envia uma resposta e obtém a próxima pergunta"""
+    if not session.get('game_active'):
+        return jsonify({'success': False, 'error': 'Nenhum jogo ativo'})
+
+    data = request.get_json()
+    if session.get('answer') is None or not isinstance(session.get('question_start_time'), float):
+        return jsonify({'success': False, 'error': 'Nenhuma pergunta atual'})
+
+    now = time.time()
+    new_state, response = _score_answer(session, data.get('answer'), now)
+    session.update(new_state)
 
     # Gera a próxima pergunta
-    next_question = generate_question(session['difficulty'])
-    session['current_question'] = next_question
-    session['question_start_time'] = datetime.now().isoformat()
+    next_question = generate_question(session['difficulty_idx'])
+    session['answer'] = next_question['answer']
+    session['question_start_time'] = now
 
     return jsonify({
         'success': True,
-        'is_correct': is_correct,
-        'correct_answer': correct_answer,
-        'score': session['score'],
+        **response,
         'next_question': next_question['question'],
-        'time_limit': next_question['time_limit'],
-        'total_questions': session['total_questions'],
-        'correct_answers': session['correct_answers']
+        'time_limit': next_question['time_limit']
     })
 
 @app.route('/end_game', methods=['POST'])
@@ -181,21 +478,33 @@ def end_game():
     if not session.get('game_active'):
         return jsonify({'success': False, 'error': 'Nenhum jogo ativo'})
 
+    # Sessões criadas antes do uso de timestamps numéricos guardam start_time como texto ISO
+    if not isinstance(session.get('start_time'), float):
+        session['game_active'] = False
+        return jsonify({'success': False, 'error': 'Jogo inválido, inicie um novo jogo'})
+
     # Calcula as estatísticas finais
-    game_duration = (datetime.now() - datetime.fromisoformat(session['start_time'])).total_seconds()
+    now = time.time()
+    game_duration = now - session['start_time']
     accuracy = (session['correct_answers'] / session['total_questions'] * 100) if session['total_questions'] > 0 else 0
 
-    # Salva o resultado do jogo no banco de dados
-    game_result = models.GameResult()
-    game_result.difficulty = session['difficulty']
-    game_result.score = session['score']
-    game_result.total_questions = session['total_questions']
-    game_result.correct_answers = session['correct_answers']
-    game_result.accuracy = accuracy
-    game_result.duration = game_duration
+    result = {
+        'difficulty': session['difficulty'],
+        'score': session['score'],
+        'total_questions': session['total_questions'],
+        'correct_answers': session['correct_answers'],
+        'accuracy': accuracy,
+        'duration': game_duration,
+        'created_at': datetime.fromtimestamp(now)
+    }
 
-    db.session.add(game_result)
-    db.session.commit()
+    # Resultados que entram no ranking são gravados na hora, para aparecerem
+    # imediatamente; os demais vão para a gravação em lote
+    min_top = _leaderboard_threshold()
+    if min_top is None or result['score'] > min_top:
+        _save_results([result])
+    else:
+        enqueue_result(result)
 
     final_stats = {
         'score': session['score'],
@@ -217,18 +526,38 @@ def end_game():
 @app.route('/get_leaderboard')
 def get_leaderboard():
     """Obtém as melhores pontuações para o ranking"""
-    top_scores = models.GameResult.query.order_by(models.GameResult.score.desc()).limit(10).all()
+    now = time.monotonic()
+    with _leaderboard_cache_lock:
+        if now < _leaderboard_cache['expires']:
+            return jsonify({'leaderboard': _leaderboard_cache['leaderboard']})
+        generation = _leaderboard_cache['generation']
+
+    Leaderboard = models.LeaderboardEntry
+    top_scores = db.session.execute(
+        select(
+            Leaderboard.score,
+            Leaderboard.difficulty,
+            Leaderboard.accuracy,
+            Leaderboard.created_at
+        ).order_by(Leaderboard.score.desc()).limit(LEADERBOARD_SIZE)
+    ).all()
 
     leaderboard = []
-    for result in top_scores:
+    for score, difficulty, accuracy, created_at in top_scores:
         leaderboard.append({
-            'score': result.score,
-            'difficulty': result.difficulty,
-            'accuracy': round(result.accuracy, 1),
-            'date': result.created_at.strftime('%Y-%m-%d')
+            'score': score,
+            'difficulty': difficulty,
+            'accuracy': round(accuracy, 1),
+            'date': created_at.strftime('%Y-%m-%d')
         })
 
+    # Só guarda o resultado se o ranking não mudou durante a consulta
+    with _leaderboard_cache_lock:
+        if _leaderboard_cache['generation'] == generation:
+            _leaderboard_cache['leaderboard'] = leaderboard
+            _leaderboard_cache['expires'] = now + LEADERBOARD_CACHE_TTL
+
     return jsonify({'leaderboard': leaderboard})
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=os.environ.get("FLASK_DEBUG") == "1")
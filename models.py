@@ -4,7 +4,7 @@ from app import db
 class GameResult(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     difficulty = db.Column(db.String(50), nullable=False)
-    score = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Integer, nullable=False, index=True)
     total_questions = db.Column(db.Integer, nullable=False)
     correct_answers = db.Column(db.Integer, nullable=False)
     accuracy = db.Column(db.Float, nullable=False)
@@ -13,3 +13,14 @@ class GameResult(db.Model):
 
     def __repr__(self):
         return f'<GameResult {self.id}>'
+
+class LeaderboardEntry(db.Model):
+    """As 10 melhores pontuações, mantidas à parte para leitura rápida do ranking"""
+    id = db.Column(db.Integer, primary_key=True)
+    difficulty = db.Column(db.String(50), nullable=False)
+    score = db.Column(db.Integer, nullable=False, index=True)
+    accuracy = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return f'<LeaderboardEntry {self.id}>'